@@ -1,11 +1,21 @@
 import streamlit as st
-import pdfplumber
 import edge_tts
 import asyncio
 import re
 import os
 import time
-from tenacity import retry, stop_after_attempt, wait_fixed
+import hashlib
+import html
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# uvloop is a faster drop-in event loop for the TTS workers. Not available on Windows.
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+from pdf_text import HAS_PYMUPDF, extract_with_pymupdf, extract_with_pdfplumber
 
 # Page Configuration
 st.set_page_config(page_title="Prof. AI: Audio Classes", layout="wide")
@@ -16,6 +26,23 @@ st.write("I will read your questions, answers, and explanations in a detailed, t
 # --- Step 1: Upload File ---
 uploaded_file = st.file_uploader("Upload your Q&A PDF", type="pdf")
 
+# Regex to split by "Q" + number OR just number + dot
+# Matches: "Q1.", "1.", "10."
+_Q_SPLIT = re.compile(r"(?=\b(?:Q)?\d+\.\s)")
+# Finds the label (e.g., "1" or "Q1")
+_Q_LABEL = re.compile(r"((?:Q)?\d+)")
+
+# STRICT WHITELIST
+# We only keep letters, numbers, and basic punctuation.
+# We removed the hyphen (-) to automatically clean '--- PAGE ---' headers.
+_ALLOWED = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 .,?!:;")
+
+# Every whitelisted character is ASCII, so the filter can run on bytes:
+# newlines become spaces so the voice doesn't pause weirdly, and the other
+# ASCII bytes outside the whitelist are deleted. Built once, never per call.
+_NEWLINE_TO_SPACE = bytes.maketrans(b"\n", b" ")
+_BAD_BYTES = bytes(b for b in range(128) if chr(b) not in _ALLOWED and b != ord("\n"))
+
 def safe_clean_text(text):
     """
     Cleans text using a Strict Filter.
@@ -25,62 +52,53 @@ def safe_clean_text(text):
     if not text:
         return ""
     
-    # Replace newlines with spaces so the voice doesn't pause weirdly
-    text = text.replace("\n", " ")
-    
-    # STRICT WHITELIST
-    # We only keep letters, numbers, and basic punctuation.
-    # We removed the hyphen (-) to automatically clean '--- PAGE ---' headers.
-    allowed_chars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 .,?!:;"
-    
-    clean_chars = []
-    for char in text:
-        if char in allowed_chars:
-            clean_chars.append(char)
-            
-    # Join the safe characters back together
-    cleaned_text = "".join(clean_chars)
+    # Drop non-ASCII while encoding, then map newlines and drop the rest
+    # of the non-whitelisted bytes in the same translate pass
+    cleaned_text = (
+        text.encode("ascii", "ignore")
+        .translate(_NEWLINE_TO_SPACE, _BAD_BYTES)
+        .decode("ascii")
+    )
     
     # Remove extra spaces created by filtering
     return " ".join(cleaned_text.split())
 
-def extract_text_from_pdf(file):
-    """Extracts raw text from PDF."""
-    all_text = ""
-    with pdfplumber.open(file) as pdf:
-        for page in pdf.pages:
-            text = page.extract_text()
-            if text:
-                all_text += text + "\n"
-    return all_text
+@st.cache_data(show_spinner=False)
+def extract_text_from_pdf(file_bytes):
+    """
+    Extracts raw text from PDF.
+    Takes the raw file bytes so Streamlit can cache the result between reruns.
+    """
+    if HAS_PYMUPDF:
+        try:
+            return extract_with_pymupdf(file_bytes)
+        except RuntimeError:
+            # MuPDF couldn't read this file; pdfplumber is more forgiving with some
+            pass
+    return extract_with_pdfplumber(file_bytes)
 
 def create_professor_script(label, main_text, explanation_text):
     """
     Creates a 'Professor' script using natural language.
     """
-    # Intro
-    script = f"Okay, let's move to {label}. "
-    
-    # Question and Answer
-    script += f"The question is: {main_text}. "
-    
     # Explanation
     if explanation_text:
-        script += f" Now, let me explain the details. {explanation_text} "
-        script += " So, that is the main point to remember here. "
+        outro = (
+            f" Now, let me explain the details. {explanation_text} "
+            " So, that is the main point to remember here. "
+        )
     else:
-        script += " That covers the answer for this one. "
-        
-    return script
+        outro = " That covers the answer for this one. "
+    
+    # Intro, then Question and Answer, built in one go
+    return f"Okay, let's move to {label}. The question is: {main_text}. {outro}"
 
+@st.cache_data(show_spinner=False)
 def parse_pdf_to_lessons(text):
     """
     Splits text into Q&A blocks.
     """
-    # Regex to split by "Q" + number OR just number + dot
-    # Matches: "Q1.", "1.", "10."
-    pattern = r"(?=\b(?:Q)?\d+\.\s)"
-    chunks = re.split(pattern, text)
+    chunks = _Q_SPLIT.split(text)
     
     lessons = []
     
@@ -92,21 +110,19 @@ def parse_pdf_to_lessons(text):
             continue
             
         # Find the label (e.g., "1" or "Q1")
-        match = re.search(r"((?:Q)?\d+)", clean_chunk)
+        match = _Q_LABEL.search(clean_chunk)
         label = match.group(1) if match else "Question"
         
         # Split into Answer and Explanation
-        if "Explanation:" in clean_chunk:
-            parts = clean_chunk.split("Explanation:")
-            q_and_a = parts[0]
-            explanation = parts[1]
-        elif "Answer:" in clean_chunk:
-            parts = clean_chunk.split("Answer:")
-            q_and_a = parts[0] + " The answer is " + parts[1]
-            explanation = ""
+        # partition finds the marker and splits in one scan;
+        # anything after a repeated marker is dropped
+        q_and_a, sep, explanation = clean_chunk.partition("Explanation:")
+        if sep:
+            explanation = explanation.partition("Explanation:")[0]
         else:
-            q_and_a = clean_chunk
-            explanation = ""
+            head, sep, answer = clean_chunk.partition("Answer:")
+            if sep:
+                q_and_a = head + " The answer is " + answer.partition("Answer:")[0]
 
         # Clean the text
         final_main = safe_clean_text(q_and_a)
@@ -123,62 +139,285 @@ def parse_pdf_to_lessons(text):
     return lessons
 
 # --- Audio Generation with Retry ---
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(5))
-async def generate_audio(text, filename):
-    # 'en-US-ChristopherNeural' is a deep, calm male voice (Professor style)
-    voice = "en-US-ChristopherNeural"
+# How many requests we send to the TTS server at the same time
+# (whole lessons and pieces of long ones together)
+MAX_PARALLEL_AUDIO = 4
+
+# 'en-US-ChristopherNeural' is a deep, calm male voice (Professor style)
+# Set TTS_VOICE to use a different edge-tts voice without copying the app
+VOICE = os.environ.get("TTS_VOICE", "en-US-ChristopherNeural")
+
+# Retry policy: try 5 times, waiting 1, 2, 4 and then 8 seconds in between
+AUDIO_ATTEMPTS = 5
+AUDIO_RETRY_WAIT = 1
+
+# After a rate-limit error, slow down for this many seconds instead of
+# sleeping between every lesson
+RATE_LIMIT_COOLDOWN = 10
+RATE_LIMIT_PAUSE = 1.0
+
+@st.cache_resource
+def _rate_limit_state():
+    # When the server last rate-limited us. Kept outside the script's globals,
+    # which every rerun replaces, so prefetch and class jobs all see it.
+    return {"last": 0.0}
+
+_RATE_LIMIT = _rate_limit_state()
+
+# Long scripts are split at sentence ends into pieces of about this many
+# characters and generated in parallel when connections are free.
+# edge-tts mp3 pieces join back cleanly.
+AUDIO_PIECE_CHARS = 500
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+def _is_rate_limited(error):
+    # edge-tts passes on the websocket handshake error, which carries the HTTP status
+    return getattr(error, "status", None) == 429
+
+@st.cache_resource
+def _connection_slots():
+    # Caps open TTS connections across every worker thread and rerun
+    return threading.BoundedSemaphore(MAX_PARALLEL_AUDIO)
+
+_CONNECTION_SLOTS = _connection_slots()
+
+@st.cache_resource
+def _lesson_count():
+    # How many lessons are queued or running in the TTS pool, across every
+    # session. An RLock, since a job that's already done runs its callback
+    # right away, while start_audio still holds the lock.
+    return {"lessons": 0, "lock": threading.RLock()}
+
+_IN_FLIGHT = _lesson_count()
+
+async def _stream_audio(text, voice):
     communicate = edge_tts.Communicate(text, voice)
-    await communicate.save(filename)
+    
+    # Collect the mp3 chunks in memory instead of going through a file
+    buf = bytearray()
+    async for chunk in communicate.stream():
+        if chunk["type"] == "audio":
+            buf.extend(chunk["data"])
+    return bytes(buf)
+
+async def generate_audio(text, voice=VOICE):
+    # Only pause if the server pushed back recently, otherwise go full speed
+    if time.monotonic() - _RATE_LIMIT["last"] < RATE_LIMIT_COOLDOWN:
+        await asyncio.sleep(RATE_LIMIT_PAUSE)
+    
+    for attempt in range(AUDIO_ATTEMPTS):
+        try:
+            return await _stream_audio(text, voice)
+        except Exception as e:
+            if attempt == AUDIO_ATTEMPTS - 1:
+                raise
+            if _is_rate_limited(e):
+                _RATE_LIMIT["last"] = time.monotonic()
+            await asyncio.sleep(AUDIO_RETRY_WAIT * 2 ** attempt)
+
+def _split_script(script):
+    """Groups a script's sentences into pieces of about AUDIO_PIECE_CHARS."""
+    pieces = []
+    current = []
+    size = 0
+    for sentence in _SENTENCE_END.split(script.strip()):
+        if current and size + len(sentence) > AUDIO_PIECE_CHARS:
+            pieces.append(" ".join(current))
+            current = []
+            size = 0
+        current.append(sentence)
+        size += len(sentence) + 1
+    if current:
+        pieces.append(" ".join(current))
+    return pieces
+
+def _group_pieces(pieces, count):
+    """Joins consecutive pieces into `count` groups of roughly equal size."""
+    bounds = [len(pieces) * g // count for g in range(count + 1)]
+    return [" ".join(pieces[bounds[g]:bounds[g + 1]]) for g in range(count)]
+
+async def _generate_piece(text, voice):
+    # Each piece holds one connection slot and frees it as soon as it's done
+    try:
+        return await generate_audio(text, voice)
+    finally:
+        _CONNECTION_SLOTS.release()
+
+async def synthesize_script(script, voice=VOICE):
+    """
+    Generates the mp3 for a whole lesson script.
+    Long explanations are split into pieces that are generated in parallel,
+    but only on connection slots no other lesson in flight needs. When the
+    pool is busy the script goes out as one request, so its pieces never
+    compete with the lessons after it.
+    """
+    # A slot for the lesson itself. This worker thread runs one lesson at a
+    # time, so blocking it while we wait holds up nothing else.
+    _CONNECTION_SLOTS.acquire()
+    
+    # Every other queued or running lesson still needs a slot of its own
+    with _IN_FLIGHT["lock"]:
+        spare = MAX_PARALLEL_AUDIO - max(_IN_FLIGHT["lessons"], 1)
+    
+    pieces = _split_script(script)
+    extra = 0
+    while extra < min(spare, len(pieces) - 1) and _CONNECTION_SLOTS.acquire(blocking=False):
+        extra += 1
+    pieces = _group_pieces(pieces, extra + 1) if extra else [script]
+    
+    # Wait for every piece even if one fails, so all their slots are freed
+    audio = await asyncio.gather(
+        *[_generate_piece(piece, voice) for piece in pieces], return_exceptions=True
+    )
+    for result in audio:
+        if isinstance(result, BaseException):
+            raise result
+    return b"".join(audio)
+
+@st.cache_resource
+def _tts_pool():
+    """
+    Worker threads for TTS, shared across reruns.
+    Each one keeps its own event loop (see _thread_loop) for its whole life.
+    """
+    return ThreadPoolExecutor(max_workers=MAX_PARALLEL_AUDIO, thread_name_prefix="tts")
+
+@st.cache_resource
+def _loop_store():
+    # Holds one event loop per worker thread, kept across reruns
+    return threading.local()
+
+_LOOPS = _loop_store()
+
+def _thread_loop():
+    """Returns this thread's event loop, creating it the first time."""
+    loop = getattr(_LOOPS, "loop", None)
+    if loop is None:
+        loop = _LOOPS.loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+    return loop
+
+@st.cache_data(persist="disk", max_entries=2000, show_spinner=False)
+def tts_bytes(script, voice=VOICE):
+    """
+    Returns the mp3 bytes for one script.
+    Cached on disk by (script, voice), so reruns and app restarts
+    skip the TTS round trip.
+    """
+    # Reuse the thread's loop instead of asyncio.run building a new one per lesson
+    return _thread_loop().run_until_complete(synthesize_script(script, voice))
+
+# How many lessons to start generating as soon as the PDF is parsed,
+# before "Start Class" is clicked
+PREFETCH_LESSONS = 4
+
+# The TTS pool is shared by every user, so one session only keeps this many
+# lessons queued or running at once. That is enough to keep the pool busy
+# for one class without making everyone else wait behind it.
+SESSION_JOBS = MAX_PARALLEL_AUDIO
+
+def _lesson_done(future):
+    # Called once a submitted lesson has finished, failed or been cancelled
+    with _IN_FLIGHT["lock"]:
+        _IN_FLIGHT["lessons"] -= 1
+
+def start_audio(lessons):
+    """
+    Starts generating these lessons' audio in the background.
+    Returns one future per lesson, in order, so each lesson can be shown
+    as soon as its audio is ready while the next ones are still generating.
+    Jobs started on an earlier rerun are reused unless they failed or were
+    cancelled. Jobs for lessons not passed in are cancelled, so ones that
+    haven't started yet give their place in the shared pool back.
+    """
+    pool = _tts_pool()
+    old_jobs = st.session_state.get("audio_jobs", {})
+    jobs = {}
+    futures = []
+    # Lessons are counted from submission, not from when a worker picks them
+    # up, and all of them before any worker looks at the count. That way a
+    # lesson still in the queue keeps earlier ones from taking its slot.
+    with _IN_FLIGHT["lock"]:
+        for lesson in lessons:
+            script = lesson["script"]
+            future = jobs.get(script) or old_jobs.get(script)
+            # A cancelled future has no exception to ask for, so check that first
+            stale = future is not None and (
+                future.cancelled() or (future.done() and future.exception() is not None)
+            )
+            if future is None or stale:
+                _IN_FLIGHT["lessons"] += 1
+                future = pool.submit(tts_bytes, script)
+                future.add_done_callback(_lesson_done)
+            jobs[script] = future
+            futures.append(future)
+    for script, future in old_jobs.items():
+        if script not in jobs:
+            future.cancel()
+    st.session_state.audio_jobs = jobs
+    return futures
 
 # --- Main App ---
 if uploaded_file is not None:
-    with st.spinner("Processing PDF..."):
-        raw_text = extract_text_from_pdf(uploaded_file)
-        lessons = parse_pdf_to_lessons(raw_text)
+    # Every widget click reruns this script, so keep the parsed lessons
+    # for this PDF in the session instead of fetching them again
+    file_bytes = uploaded_file.getvalue()
+    pdf_hash = hashlib.sha256(file_bytes).hexdigest()
+    if st.session_state.get("pdf_hash") != pdf_hash:
+        with st.spinner("Processing PDF..."):
+            # Pass the bytes, not the upload handle, so the cache key is stable
+            raw_text = extract_text_from_pdf(file_bytes)
+            st.session_state.lessons = parse_pdf_to_lessons(raw_text)
+        st.session_state.pdf_hash = pdf_hash
+    lessons = st.session_state.lessons
     
     st.success(f"Found {len(lessons)} questions.")
     
+    # Get the first lessons going while the user is still reading the page.
+    # Jobs an earlier PDF or class run left queued are cancelled here, so
+    # these don't wait behind them.
+    start_audio(lessons[:PREFETCH_LESSONS])
+    
     if st.button("Start Class (Generate Audio)"):
         
+        # One status element for the whole class, lessons render below it
+        status = st.status("Professor is preparing the class...")
         progress_bar = st.progress(0)
-        status_box = st.empty()
+        
+        # Every UI update is a round trip to the browser,
+        # so only move the progress bar every ~5% of the class
+        step = max(1, len(lessons) // 20)
         
         for i, lesson in enumerate(lessons):
             label = lesson["label"]
             
             # Update Progress
-            progress = (i + 1) / len(lessons)
-            progress_bar.progress(progress)
-            status_box.text(f"Professor is reading {label}...")
+            if i % step == 0:
+                progress = (i + 1) / len(lessons)
+                progress_bar.progress(progress)
+                status.update(label=f"Professor is reading {label}...")
             
-            with st.container():
-                st.subheader(f"🎓 {label}")
-                
-                # Show Text (Optional)
-                with st.expander("Show Transcript"):
-                    st.write(lesson["script"])
+            # Divider, title and transcript (optional, folded) go out as one
+            # element instead of a container, subheader, expander and divider
+            divider = "---\n\n" if i > 0 else ""
+            transcript = html.escape(lesson["script"])
+            st.markdown(
+                f"{divider}### 🎓 {html.escape(label)}\n\n"
+                f"<details><summary>Show Transcript</summary>{transcript}</details>",
+                unsafe_allow_html=True,
+            )
+            
+            try:
+                # Audio for the next few lessons is generated while this one is
+                # shown, so it's usually ready already
+                audio_bytes = start_audio(lessons[i:i + SESSION_JOBS])[0].result()
                 
-                filename = f"audio_{i}.mp3"
+                # Play Audio
+                st.audio(audio_bytes, format="audio/mp3")
                 
-                try:
-                    # Generate Audio
-                    asyncio.run(generate_audio(lesson["script"], filename))
-                    
-                    # Play Audio
-                    with open(filename, "rb") as f:
-                        audio_bytes = f.read()
-                        st.audio(audio_bytes, format="audio/mp3")
-                    
-                    # Cleanup
-                    os.remove(filename)
-                    
-                    # Sleep to prevent server blocking
-                    time.sleep(2.0)
-                    
-                except Exception as e:
-                    st.error(f"Error on {label}: {e}")
-            
-            st.divider()
+            except Exception as e:
+                st.error(f"Error on {label}: {e}")
             
-        status_box.text("Class Complete!")
+        st.divider()
+        progress_bar.progress(1.0)
+        status.update(label="Class Complete!", state="complete")
         st.balloons()
@@ -0,0 +1,101 @@
+"""
+PDF text extraction helpers.
+Kept out of app.py (no Streamlit here) so worker processes can import them.
+"""
+import io
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import pdfplumber
+from pdfminer.pdftypes import resolve1
+
+# PyMuPDF is much faster than pdfplumber for plain text. Fall back if it's missing.
+try:
+    import pymupdf
+except ImportError:
+    pymupdf = None
+
+HAS_PYMUPDF = pymupdf is not None
+
+# Below this many pages per worker, starting processes costs more than it saves.
+# A spawned worker took ~0.45 s to start, import pdfplumber and open a 200-page
+# PDF, about as long as extracting 4 dense text pages (~0.1 s each), so 8 pages
+# leaves a 2x margin.
+MIN_PAGES_PER_WORKER = 8
+
+def extract_with_pymupdf(file_bytes):
+    """Fast path: PyMuPDF's C engine, plain text only."""
+    doc = pymupdf.open(stream=file_bytes, filetype="pdf")
+    try:
+        # Pages that reference no fonts (scans, figures) can't contain text,
+        # so skip interpreting their content streams
+        return "\n".join(page.get_text("text") for page in doc if page.get_fonts())
+    finally:
+        doc.close()
+
+def _may_have_text(page):
+    """
+    Cheap check on a pdfplumber page before extract_text().
+    Text needs a font, so a page whose resources have no fonts (e.g. a scanned
+    image) is skipped without parsing its content stream. Form XObjects carry
+    their own resources, so a page that uses one is kept to be safe.
+    """
+    resources = resolve1(page.page_obj.resources) or {}
+    if resolve1(resources.get("Font")):
+        return True
+    xobjects = resolve1(resources.get("XObject")) or {}
+    for xobj in xobjects.values():
+        subtype = resolve1(xobj).get("Subtype")
+        if getattr(subtype, "name", None) == "Form":
+            return True
+    return False
+
+def _extract_page_range(file_bytes, start, end):
+    """Worker: opens its own copy of the PDF and reads pages [start, end)."""
+    # Collect pages in a list and join once, so this stays linear in the page count
+    parts = []
+    with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
+        for i in range(start, end):
+            page = pdf.pages[i]
+            if not _may_have_text(page):
+                continue
+            # The simple extractor just sorts chars into lines; TTS doesn't
+            # need the word/layout grouping that extract_text() does
+            text = page.extract_text_simple()
+            # Drop the page's parsed objects now, so big PDFs don't keep them all
+            page.flush_cache()
+            if text:
+                parts.append(text)
+    return "\n".join(parts)
+
+def _usable_cpus():
+    # CPUs this process may run on; containers often allow fewer than cpu_count()
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def extract_with_pdfplumber(file_bytes):
+    """
+    Slow fallback used when PyMuPDF isn't installed.
+    pdfplumber is pure Python, so big PDFs are split across processes.
+    """
+    with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
+        n_pages = len(pdf.pages)
+
+    workers = min(_usable_cpus(), n_pages // MIN_PAGES_PER_WORKER)
+    if workers <= 1:
+        return _extract_page_range(file_bytes, 0, n_pages)
+
+    # Roughly equal page ranges, one per worker, kept in page order
+    bounds = [n_pages * w // workers for w in range(workers + 1)]
+    # Spawn fresh workers: forking the Streamlit server while its threads
+    # are running can deadlock the children
+    spawn = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=spawn) as pool:
+        futures = [
+            pool.submit(_extract_page_range, file_bytes, bounds[w], bounds[w + 1])
+            for w in range(workers)
+        ]
+        parts = [future.result() for future in futures]
+    return "\n".join(part for part in parts if part)